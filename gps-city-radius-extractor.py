@@ -8,20 +8,61 @@ for matching geotagged images.
 """
 
 import os
+import argparse
+import json
 import math
+import hashlib
+import functools
+import shutil
 import zipfile
 import requests
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from geopy.distance import geodesic
+from joblib import Parallel, delayed
+from sklearn.neighbors import BallTree
+
+# Numba is optional; without it the grid is generated with NumPy per city
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Dask is optional; it is only needed for the sharded Parquet output
+try:
+    import dask.dataframe as dd
+except ImportError:
+    dd = None
 
 # Constants
 EARTH_RADIUS_KM = 6371.0  # Earth radius in kilometers
 CITY_RADIUS_KM = 20.0     # Radius around cities in kilometers
 GRID_SPACING_KM = 1.0     # Spacing between grid points in km
 OUTPUT_DIR = "data"       # Directory for output
-OUTPUT_FILE = "city_gps_points.csv"  # Output filename
+OUTPUT_FILES = {          # Output filename per --format
+    'parquet': "city_gps_points.parquet",
+    'csv': "city_gps_points.csv",
+    'shards': "city_gps_points",  # Directory of Parquet shards written by Dask
+}
+CITY_BATCH_SIZE = 500     # Cities processed and written per batch
+COORD_DECIMALS = 5        # Decimal places kept in output (~1m precision)
+TIE_EPSILON_KM = 1e-6     # Distances closer than this (1mm) count as a tie between cities
+
+# Column layout of the output file
+POINTS_SCHEMA = pa.schema([
+    ('city_id', pa.int32()),
+    ('city_name', pa.string()),
+    ('country', pa.string()),
+    ('population', pa.int32()),
+    ('city_lat', pa.float32()),
+    ('city_lon', pa.float32()),
+    ('point_lat', pa.float32()),
+    ('point_lon', pa.float32()),
+    ('distance_km', pa.float32()),
+])
 
 def download_city_data():
     """Download and extract the cities15000.zip file"""
@@ -34,15 +75,15 @@ def download_city_data():
     # Check if the file already exists
     if not os.path.exists(zip_path):
         print("Downloading cities15000.zip...")
-        response = requests.get(cities_url, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
-        
-        with open(zip_path, 'wb') as f:
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc="Downloading") as pbar:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+        with requests.get(cities_url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            total_size = int(response.headers.get('content-length', 0))
+            
+            # Let copyfileobj do the chunked copy; tqdm just observes the reads
+            with open(zip_path, 'wb') as f:
+                with tqdm.wrapattr(response.raw, 'read', total=total_size, desc="Downloading") as raw:
+                    shutil.copyfileobj(raw, f, length=1 << 20)
     
     # Extract the zip file
     csv_path = os.path.join(OUTPUT_DIR, "cities15000.txt")
@@ -63,44 +104,75 @@ def parse_city_data(city_file):
         'dem', 'timezone', 'modification_date'
     ]
     
-    # Read the tab-delimited file
-    df = pd.read_csv(city_file, sep='\t', header=None, names=columns, encoding='utf-8')
+    # Only these columns are used downstream; the rest are never parsed
+    column_types = {
+        'geonameid': pa.int64(),
+        'name': pa.string(),
+        'latitude': pa.float64(),
+        'longitude': pa.float64(),
+        'country_code': pa.string(),
+        'population': pa.int64(),
+    }
     
-    # Convert latitude and longitude to float
-    df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
-    df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
-    
-    # Convert population to int
-    df['population'] = pd.to_numeric(df['population'], errors='coerce').astype('Int64')
+    # Read the tab-delimited file with Arrow's multithreaded parser.
+    # Geonames fields are never quoted, but names may contain quote characters.
+    table = pa_csv.read_csv(
+        city_file,
+        read_options=pa_csv.ReadOptions(column_names=columns),
+        parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(column_types),
+            column_types=column_types,
+        ),
+    )
     
     # Drop rows with missing lat, lon, or population
-    df = df.dropna(subset=['latitude', 'longitude', 'population'])
+    table = table.drop_null()
     
     # Sort by population in descending order
-    df = df.sort_values('population', ascending=False)
+    table = table.sort_by([('population', 'descending')])
+    
+    df = table.to_pandas()
     
     print(f"Loaded {len(df)} cities with population ≥ 15,000")
     return df
 
-def haversine(lat1, lon1, lat2, lon2):
+@functools.lru_cache(maxsize=None)
+def unit_grid(radius_km=CITY_RADIUS_KM, spacing_km=GRID_SPACING_KM):
     """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+    Precompute the grid offsets that fall within the radius of a city.
+    
+    On a locally flat grid the set of (row, column) steps inside the circle
+    and their distances are the same for every city; only the conversion
+    from steps to degrees depends on latitude. Computed once and cached.
     """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    # Number of grid steps from the city centre to the edge of the radius
+    n = math.ceil(radius_km / spacing_km)
+    di, dj = np.mgrid[-n:n + 1, -n:n + 1]
     
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    distance = EARTH_RADIUS_KM * c
+    # Keep only the steps within the radius, comparing integer squared step counts.
+    # The bound comes from a float ratio, so a small epsilon absorbs its rounding
+    # error (e.g. 0.3km / 0.1km evaluates to 2.9999999999999996 and would
+    # otherwise lose the edge points)
+    max_steps2 = math.floor((radius_km / spacing_km)**2 + 1e-9)
+    steps2 = di * di + dj * dj
+    mask = steps2 <= max_steps2
+    di, dj = di[mask], dj[mask]
+    distances = spacing_km * np.sqrt(steps2[mask])
     
-    return distance
+    # The arrays are shared between calls, so guard them against mutation
+    for arr in (di, dj, distances):
+        arr.flags.writeable = False
+    
+    return di, dj, distances
 
 def create_dense_grid(lat, lon, radius_km=CITY_RADIUS_KM, spacing_km=GRID_SPACING_KM):
-    """Create a dense grid of points within a specified radius"""
+    """
+    Create a dense grid of points within a specified radius.
+    
+    Returns three arrays: point latitudes, point longitudes and their
+    distances (km) from the city centre.
+    """
     # Approximate degrees per km (varies by latitude)
     km_per_degree_lat = 111.0  # 1 degree of latitude is approximately 111km
     degrees_per_km_lat = 1.0 / km_per_degree_lat
@@ -112,103 +184,286 @@ def create_dense_grid(lat, lon, radius_km=CITY_RADIUS_KM, spacing_km=GRID_SPACIN
     lat_step = degrees_per_km_lat * spacing_km
     lon_step = degrees_per_km_lon * spacing_km
     
-    # Calculate grid boundaries
-    lat_radius_in_degrees = radius_km * degrees_per_km_lat
-    lon_radius_in_degrees = radius_km * degrees_per_km_lon
-    
-    min_lat = lat - lat_radius_in_degrees
-    max_lat = lat + lat_radius_in_degrees
-    min_lon = lon - lon_radius_in_degrees
-    max_lon = lon + lon_radius_in_degrees
-    
-    # Generate grid points
-    grid_points = []
-    current_lat = min_lat
-    
-    while current_lat <= max_lat:
-        current_lon = min_lon
-        while current_lon <= max_lon:
-            # Check if the point is within the radius
-            distance = haversine(lat, lon, current_lat, current_lon)
-            if distance <= radius_km:
-                grid_points.append((current_lat, current_lon, distance))
+    # Within a 20km radius the earth is locally flat, so the offsets and
+    # distances are shared by every city and only need scaling to degrees
+    di, dj, distances = unit_grid(radius_km, spacing_km)
+    
+    return lat + di * lat_step, lon + dj * lon_step, distances
+
+def _grid_kernel(lats, lons, di, dj, spacing_km, out_lat, out_lon):
+    """Write the grid points of every city into its own slice of out_lat/out_lon"""
+    points_per_city = len(di)
+    lat_step = spacing_km / 111.0
+    for i in range(len(lats)):
+        lon_step = spacing_km / (111.0 * math.cos(math.radians(lats[i])))
+        base = i * points_per_city
+        for k in range(points_per_city):
+            out_lat[base + k] = lats[i] + di[k] * lat_step
+            out_lon[base + k] = lons[i] + dj[k] * lon_step
+
+# Compile the kernel when Numba is available; otherwise fall back to NumPy per city.
+# Parallelism comes from the worker processes, so the kernel itself stays serial.
+if njit is not None:
+    _grid_kernel = njit(cache=True, fastmath=True)(_grid_kernel)
+
+def _to_float32(values):
+    """Round to COORD_DECIMALS in double precision, then narrow to float32"""
+    return np.round(values, COORD_DECIMALS).astype(np.float32)
+
+def process_chunk(df, neighbours, city_lats, city_lons, spacing_km=GRID_SPACING_KM):
+    """
+    Generate the grid points for a chunk of cities as a dict of column arrays.
+    
+    df.index holds each city's position in the full population-ordered city
+    list, and neighbours/city_lats/city_lons come from find_neighbouring_cities.
+    """
+    # Every city gets the same grid offsets, so the output size is known up front
+    di, dj, distances = unit_grid(CITY_RADIUS_KM, spacing_km)
+    points_per_city = len(di)
+    total = points_per_city * len(df)
+    
+    lats = df['latitude'].to_numpy(np.float64)
+    lons = df['longitude'].to_numpy(np.float64)
+    
+    # Points are computed in double precision and only narrowed for output
+    point_lats = np.empty(total, dtype=np.float64)
+    point_lons = np.empty(total, dtype=np.float64)
+    
+    if njit is not None:
+        # Compiled kernel fills the points of all cities in the chunk
+        _grid_kernel(lats, lons, di, dj, spacing_km, point_lats, point_lons)
+    else:
+        # Process each city, indexing the column arrays rather than building a row Series
+        offset = 0
+        for i in range(len(lats)):
+            # Create dense grid around the city
+            grid_lats, grid_lons, _ = create_dense_grid(lats[i], lons[i], CITY_RADIUS_KM, spacing_km)
             
-            current_lon += lon_step
-        current_lat += lat_step
+            # Write the points into this city's slice
+            end = offset + points_per_city
+            point_lats[offset:end] = grid_lats
+            point_lons[offset:end] = grid_lons
+            offset = end
+    
+    # Where radii overlap, keep each location only for its nearest city
+    keep = nearest_city_mask(df.index.to_numpy(), neighbours, city_lats, city_lons,
+                             point_lats, point_lons, distances)
     
-    return grid_points
+    # One array per output column; city metadata is repeated once per grid point
+    columns = {
+        'city_id': np.repeat(df['geonameid'].to_numpy(np.int32), points_per_city),
+        'city_name': np.repeat(df['name'].to_numpy(object), points_per_city),
+        'country': np.repeat(df['country_code'].to_numpy(object), points_per_city),
+        'population': np.repeat(df['population'].to_numpy(np.int32), points_per_city),
+        'city_lat': np.repeat(_to_float32(lats), points_per_city),
+        'city_lon': np.repeat(_to_float32(lons), points_per_city),
+        'point_lat': _to_float32(point_lats),
+        'point_lon': _to_float32(point_lons),
+        'distance_km': np.tile(_to_float32(distances), len(df)),
+    }
+    
+    return {name: values[keep] for name, values in columns.items()}
 
-def process_cities(df, spacing_km=GRID_SPACING_KM):
-    """Process city data and generate a dense grid of GPS points"""
-    # Create a list to store all grid points
-    all_points = []
-    
-    # Process each city
-    total_points = 0
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Processing cities"):
-        city_id = row['geonameid']
-        city_name = row['name']
-        lat = row['latitude']
-        lon = row['longitude']
-        population = row['population']
-        country = row['country_code']
-        
-        # Create dense grid around the city
-        grid_points = create_dense_grid(lat, lon, CITY_RADIUS_KM, spacing_km)
-        
-        # Add each point to the list with metadata
-        for point_lat, point_lon, distance in grid_points:
-            all_points.append({
-                'city_id': int(city_id),
-                'city_name': city_name,
-                'country': country,
-                'population': int(population),
-                'city_lat': float(lat),
-                'city_lon': float(lon),
-                'point_lat': float(point_lat),
-                'point_lon': float(point_lon),
-                'distance_km': float(distance)
-            })
+def nearest_city_mask(positions, neighbours, city_lats, city_lons, point_lats, point_lons, distances):
+    """
+    Flag the grid points that are no closer to another city than to their own.
+    
+    Only cities with a neighbour within twice the radius can lose points, so
+    all other cities are kept without any distance work. Distances use the same
+    flat-earth approximation as the grid, and exact ties go to the city that is
+    earlier in population order, so each location is kept by exactly one city.
+    """
+    points_per_city = len(distances)
+    keep = np.ones(len(positions) * points_per_city, dtype=bool)
+    own = distances[:, None]
+    
+    for i, (city, others) in enumerate(zip(positions, neighbours)):
+        if len(others) == 0:
+            continue
         
-        total_points += len(grid_points)
+        # Distances from this city's points to each neighbouring city centre
+        rows = slice(i * points_per_city, (i + 1) * points_per_city)
+        km_per_degree_lon = 111.0 * math.cos(math.radians(city_lats[city]))
+        dy = (point_lats[rows, None] - city_lats[others]) * 111.0
+        dlon = (point_lons[rows, None] - city_lons[others] + 180.0) % 360.0 - 180.0
+        other = np.sqrt(dy**2 + (dlon * km_per_degree_lon)**2)
         
-        # Display progress after each city
-        #if (idx + 1) % 100 == 0 or idx == len(df) - 1:
-        #    print(f"Processed {idx + 1}/{len(df)} cities, generated {total_points} points so far")
+        closer = other < own - TIE_EPSILON_KM
+        tied = (np.abs(other - own) <= TIE_EPSILON_KM) & (others < city)
+        keep[rows] = ~(closer | tied).any(axis=1)
+    
+    return keep
+
+def build_city_tree(df):
+    """Index all city centres in a BallTree for great-circle neighbour queries"""
+    return BallTree(np.radians(df[['latitude', 'longitude']].to_numpy(np.float64)), metric='haversine')
+
+def find_neighbouring_cities(df, radius_km=CITY_RADIUS_KM):
+    """
+    Find, for each city, the positions of other cities whose radius overlaps its own.
+    
+    Two radii can only overlap if the centres are within 2 * radius_km, so a
+    single query_radius call on the city tree finds every candidate. The search
+    radius gets a 1% margin because the grid's flat-earth distances are slightly
+    shorter than great-circle ones. Returns the neighbour index arrays along with
+    the city latitude and longitude arrays they index into.
+    """
+    city_tree = build_city_tree(df)
+    centres = np.radians(df[['latitude', 'longitude']].to_numpy(np.float64))
+    candidates = city_tree.query_radius(centres, r=2 * radius_km * 1.01 / EARTH_RADIUS_KM)
+    neighbours = [others[others != i] for i, others in enumerate(candidates)]
     
-    # Convert to DataFrame
-    return pd.DataFrame(all_points)
+    return neighbours, df['latitude'].to_numpy(np.float64), df['longitude'].to_numpy(np.float64)
+
+def process_cities(df, spacing_km=GRID_SPACING_KM):
+    """
+    Process city data and generate a dense grid of GPS points.
+    
+    Yields one Arrow table per batch of CITY_BATCH_SIZE cities so the
+    caller can stream the points to disk instead of holding them all.
+    """
+    # Positions in population order identify cities across batches
+    df = df.reset_index(drop=True)
+    neighbours, city_lats, city_lons = find_neighbouring_cities(df)
+    
+    # Cities are independent, so process them in batches across all cores
+    starts = range(0, len(df), CITY_BATCH_SIZE)
+    
+    parallel = Parallel(n_jobs=-1, backend='loky', return_as='generator')
+    results = parallel(
+        delayed(process_chunk)(df.iloc[start:start + CITY_BATCH_SIZE], neighbours[start:start + CITY_BATCH_SIZE],
+                               city_lats, city_lons, spacing_km)
+        for start in starts
+    )
+    for columns in tqdm(results, total=len(starts), desc="Processing cities"):
+        yield pa.Table.from_pydict(columns, schema=POINTS_SCHEMA)
+
+def partition_points(df, neighbours, city_lats, city_lons, spacing_km=GRID_SPACING_KM):
+    """Generate the grid points for one Dask partition of cities as a DataFrame"""
+    return pd.DataFrame(process_chunk(df, neighbours, city_lats, city_lons, spacing_km))
+
+def process_cities_dask(df, output_path, spacing_km=GRID_SPACING_KM):
+    """
+    Generate the grid points with Dask and write one Parquet shard per partition.
+    
+    Each partition holds CITY_BATCH_SIZE cities, the same batch size as the
+    streaming path, and runs on Dask's multiprocessing scheduler. Memory use is
+    bounded by a few partitions at a time. Returns the number of points.
+    """
+    # Positions in population order identify cities across partitions
+    df = df.reset_index(drop=True)
+    neighbours, city_lats, city_lons = find_neighbouring_cities(df)
+    
+    # One partition per batch, each given only its own cities' neighbour lists
+    starts = range(0, len(df), CITY_BATCH_SIZE)
+    points = dd.from_map(
+        partition_points,
+        [df.iloc[start:start + CITY_BATCH_SIZE] for start in starts],
+        [neighbours[start:start + CITY_BATCH_SIZE] for start in starts],
+        args=(city_lats, city_lons, spacing_km),
+        meta=POINTS_SCHEMA.empty_table().to_pandas(),
+    )
+    points.to_parquet(
+        output_path, engine='pyarrow', schema=POINTS_SCHEMA, compression='zstd',
+        write_index=False, overwrite=True, compute_kwargs={'scheduler': 'processes'},
+    )
+    
+    return pq.ParquetDataset(output_path).read(columns=[]).num_rows
+
+def file_sha256(path):
+    """Return the SHA-256 hex digest of a file, read in 1 MiB chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_cache_info(cache_path):
+    """Read the sidecar written by a previous run, or None if there isn't a usable one"""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def clean_up_temp_files():
+    """Remove the downloaded geonames files"""
+    try:
+        os.remove(os.path.join(OUTPUT_DIR, "cities15000.zip"))
+        os.remove(os.path.join(OUTPUT_DIR, "cities15000.txt"))
+        print("Temporary files cleaned up")
+    except:
+        pass
+
+def open_points_writer(output_path, output_format):
+    """Open a streaming Arrow writer for the points in the requested format"""
+    if output_format == 'csv':
+        return pa_csv.CSVWriter(output_path, POINTS_SCHEMA)
+    return pq.ParquetWriter(output_path, POINTS_SCHEMA, compression='zstd')
 
 def main():
-    # Download and parse city data
+    parser = argparse.ArgumentParser(description="Generate a dense grid of GPS points around every city")
+    parser.add_argument('--format', choices=sorted(OUTPUT_FILES), default='parquet',
+                        help="output file format; 'shards' writes a directory of Parquet files with Dask (default: parquet)")
+    args = parser.parse_args()
+    if args.format == 'shards' and dd is None:
+        parser.error("--format shards requires dask[dataframe] to be installed")
+    
+    # Download city data
     city_file = download_city_data()
+    
+    output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILES[args.format])
+    cache_path = output_path + ".json"
+    
+    # Everything the generated points depend on; if unchanged, the previous output is reused
+    config = {
+        'radius_km': CITY_RADIUS_KM,
+        'spacing_km': GRID_SPACING_KM,
+        'coord_decimals': COORD_DECIMALS,
+        'geonames_sha256': file_sha256(city_file),
+    }
+    cache_info = read_cache_info(cache_path)
+    if cache_info is not None and cache_info.get('config') == config and os.path.exists(output_path):
+        print(f"\n{cache_info['n_rows']:,} GPS points for these settings already exist, skipping generation")
+        print(f"Results in {output_path}")
+        clean_up_temp_files()
+        return
+    
+    # Parse city data
     city_df = parse_city_data(city_file)
         
     # Process cities and generate GPS points
     print(f"\nGenerating dense grid of GPS points within {CITY_RADIUS_KM}km of each city (spacing: {GRID_SPACING_KM}km)...")
     
-    # Estimate the number of points per city for a rough progress indicator
-    estimated_points_per_city = int(math.pi * (CITY_RADIUS_KM / GRID_SPACING_KM) ** 2)
-    print(f"Estimated points per city: ~{estimated_points_per_city} (total may be {estimated_points_per_city * len(city_df):,} points)")
-    
-    points_df = process_cities(city_df, GRID_SPACING_KM)
+    # Cities whose radii overlap share those points, so this is only an upper bound
+    points_per_city = len(unit_grid(CITY_RADIUS_KM, GRID_SPACING_KM)[0])
+    print(f"Points per city before overlap removal: {points_per_city} (at most {points_per_city * len(city_df):,} points)")
     
     # Create output directory if it doesn't exist
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     
-    # Save to CSV
-    output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILE)
-    points_df.to_csv(output_path, index=False)
-    print(f"\nGenerated {len(points_df):,} GPS points around {len(city_df):,} cities")
+    # The output is about to be overwritten, so invalidate the old sidecar first
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    
+    if args.format == 'shards':
+        # Let Dask partition the cities and write the shards in parallel
+        total_points = process_cities_dask(city_df, output_path, GRID_SPACING_KM)
+    else:
+        # Stream each batch to disk with Arrow's native writer as it is generated
+        total_points = 0
+        with open_points_writer(output_path, args.format) as writer:
+            for batch in process_cities(city_df, GRID_SPACING_KM):
+                writer.write_table(batch)
+                total_points += batch.num_rows
+    print(f"\nGenerated {total_points:,} GPS points around {len(city_df):,} cities")
     print(f"Results saved to {output_path}")
     
-    # Clean up temporary files
-    try:
-        os.remove(os.path.join(OUTPUT_DIR, "cities15000.zip"))
-        os.remove(os.path.join(OUTPUT_DIR, "cities15000.txt"))
-        print("Temporary files cleaned up")
-    except:
-        pass
+    # Record what was generated so an identical rerun can be skipped
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump({'config': config, 'n_rows': total_points}, f, indent=2)
+    
+    clean_up_temp_files()
 
 if __name__ == "__main__":
     main()